@@ -3,14 +3,25 @@ import streamlit as st
 import os
 import shutil
 import zipfile
-from PIL import Image, ImageDraw, ImageFont, ImageColor
+from PIL import Image, ImageFont, ImageColor
 from io import BytesIO
 import hashlib
-import traceback
+import hmac
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from watermark_core import process_one, OUTPUT_FORMATS, AUTO_FORMAT, PNG_COMPRESS_LEVEL
 
 # --- Constants ---
 PRODUCTS_DIR = "products"
-OUTPUT_DIR = "branded_products"
+PRODUCT_DIRS_KEPT = 8
+LOGOS_DIR = "logos"
+LOGO_FILES_KEPT = 8
+STAGING_DIR_PREFIX = ".staging-"
+STAGING_DIR_MAX_AGE = 60 * 60
+IN_USE_MIN_AGE = 30 * 60
 FONT_FILENAME = "arial.ttf"
 DEFAULT_FONT_SIZE = 50
 DEFAULT_WATERMARK_COLOR = "#ffffff"
@@ -19,84 +30,165 @@ DEFAULT_LOGO_SCALE = 0.15
 DEFAULT_PADDING = 30
 DEFAULT_BRAND_NAME = "JhumJhum "
 DEFAULT_ADD_LOGO_BACKDROP = True
-DEFAULT_BACKDROP_COLOR = (255, 255, 255, 180)
-DEFAULT_BACKDROP_OFFSET = (2, 2)
 ALLOWED_IMAGE_TYPES = ["png", "jpg", "jpeg"]
 ALLOWED_UPLOAD_TYPES = ["zip"] + ALLOWED_IMAGE_TYPES
 KNOWN_ZIP_MIMES = ["application/zip", "application/x-zip", "application/x-zip-compressed"]
+IMAGE_EXTENSIONS = tuple(f".{ext}" for ext in ALLOWED_IMAGE_TYPES)
+MACOSX_DIR = "__MACOSX"
 
 # --- Password Protection ---
 def check_password():
+    # Streamlit reruns the script on every widget change; once authenticated, skip the rest.
+    if st.session_state.get("authenticated", False):
+        return True
     if "APP_PASSWORD_HASH" not in st.secrets:
         st.error("Password configuration missing.")
         st.stop()
-    APP_PASSWORD_HASH = st.secrets["APP_PASSWORD_HASH"]
+    try: expected_digest = bytes.fromhex(st.secrets["APP_PASSWORD_HASH"])
+    except ValueError:
+        st.error("Password configuration invalid.")
+        st.stop()
 
     def password_entered():
-        entered_hash = hashlib.sha256(st.session_state["password"].encode()).hexdigest()
-        st.session_state["authenticated"] = (entered_hash == APP_PASSWORD_HASH)
+        entered_digest = hashlib.sha256(st.session_state["password"].encode()).digest()
+        st.session_state["authenticated"] = hmac.compare_digest(entered_digest, expected_digest)
         if not st.session_state["authenticated"]: st.error("❌ Incorrect password")
 
-    if not st.session_state.get("authenticated", False):
-        st.text_input("Enter password:", type="password", on_change=password_entered, key="password")
-        st.warning("Please enter the correct password to proceed.")
-        st.stop()
-    return True
+    st.text_input("Enter password:", type="password", on_change=password_entered, key="password")
+    st.warning("Please enter the correct password to proceed.")
+    st.stop()
+
+# --- Logo check and cached font (Streamlit reruns the script on every widget change) ---
+# The logo is decoded in full once per distinct file (verify() lets truncated JPEGs through);
+# only the outcome is cached, and the workers decode their own copy from the stored file.
+@st.cache_resource(show_spinner=False, max_entries=LOGO_FILES_KEPT)
+def check_logo(logo_bytes):
+    with Image.open(BytesIO(logo_bytes)) as logo:
+        logo.load()
+
+@st.cache_resource(show_spinner=False)
+def load_font(font_filename, font_size):
+    try: return ImageFont.truetype(font_filename, font_size)
+    except IOError: return None
+
+# One worker pool for the whole server, so the per-worker logo, font, text-strip and decoded
+# product caches survive Streamlit reruns. Workers are spawned rather than forked: they start on
+# demand from a script thread of the multi-threaded server, and a forked child can deadlock on
+# locks other threads held; watermark_core imports no Streamlit, so spawning it is cheap.
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+# --- Recursive image discovery (scandir entries carry their type, so no extra stat calls) ---
+def iter_images(root):
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != MACOSX_DIR: yield from iter_images(entry.path)
+            elif not entry.name.startswith('.') and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield entry.path
+
+# --- Header-only pixel count (Image.open does not decode until pixels are needed) ---
+def pixel_count(path):
+    try:
+        with Image.open(path) as im: return im.width * im.height
+    except Exception:
+        return 0
+
+# --- Drop all but the `keep` most recently used upload folders or logo files under `root` ---
+# Staging entries left behind by interrupted writes are dropped once they are an hour old.
+# Entries used within IN_USE_MIN_AGE are kept even past `keep`: another session's queued jobs
+# may still open them by path (running batches keep touching theirs, see touch_paths).
+def remove_old_entries(root, keep):
+    found = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            # Another session's cleanup may remove an entry between the listing and the stat.
+            try: found.append((entry.stat().st_mtime, entry))
+            except OSError: pass
+    now = time.time()
+    stale = [entry for mtime, entry in found if entry.name.startswith(STAGING_DIR_PREFIX) and mtime < now - STAGING_DIR_MAX_AGE]
+    in_use = sorted((d for d in found if not d[1].name.startswith(STAGING_DIR_PREFIX)), key=lambda d: d[0], reverse=True)
+    for entry in stale + [entry for mtime, entry in in_use[keep:] if mtime < now - IN_USE_MIN_AGE]:
+        if entry.is_dir(follow_symlinks=False): shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try: os.remove(entry.path)
+            except OSError: pass
+
+# --- Mark upload folders and logo files as recently used so cleanup leaves them alone ---
+def touch_paths(*paths):
+    for path in paths:
+        try: os.utime(path)
+        except OSError: pass
+
+# --- Write the logo once under its hash; pool jobs pass the path instead of the bytes ---
+def store_logo(logo_bytes, logos_root):
+    logo_path = os.path.join(logos_root, hashlib.sha256(logo_bytes).hexdigest()[:16])
+    if os.path.exists(logo_path):
+        touch_paths(logo_path)
+        return logo_path
+    fd, staging_path = tempfile.mkstemp(prefix=STAGING_DIR_PREFIX, dir=logos_root)
+    with os.fdopen(fd, "wb") as f:
+        f.write(logo_bytes)
+    os.replace(staging_path, logo_path)
+    remove_old_entries(logos_root, LOGO_FILES_KEPT)
+    return logo_path
 
 # --- Function to Prepare Input Images (with file extension fallback) ---
-def prepare_input_images(uploaded_files, target_dir):
+# Returns (folder, image paths). Every distinct set of uploads is extracted into its own folder
+# under `products_root`, named after its hash, so sessions never see each other's images and
+# reruns with the same uploads (any sidebar tweak) reuse the extracted files.
+def prepare_input_images(uploaded_files, products_root):
     if not uploaded_files:
         st.warning("No files uploaded.")
-        return False
-    if os.path.exists(target_dir):
-        shutil.rmtree(target_dir)
-    os.makedirs(target_dir)
-
-    with st.spinner("Preparing uploaded images..."):
-        for uploaded_file in uploaded_files:
-            try:
-                is_zip = False
-                if uploaded_file.type in KNOWN_ZIP_MIMES or (uploaded_file.name and uploaded_file.name.lower().endswith(".zip")):
-                    is_zip = True
-                
-                if is_zip:
-                    with zipfile.ZipFile(BytesIO(uploaded_file.getvalue()), "r") as zip_ref:
-                        zip_ref.extractall(target_dir)
-                else:
-                    file_ext = os.path.splitext(uploaded_file.name)[1].lower().lstrip('.')
-                    if (uploaded_file.type and uploaded_file.type.split('/')[-1] in ALLOWED_IMAGE_TYPES) or (file_ext in ALLOWED_IMAGE_TYPES):
-                        with open(os.path.join(target_dir, uploaded_file.name), "wb") as f:
-                            f.write(uploaded_file.getvalue())
-                    else:
-                        st.warning(f"⚠️ Skipping unsupported file type: `{uploaded_file.name}`")
-            except Exception as e:
-                st.error(f"❌ Error processing `{uploaded_file.name}`: {e}")
+        return None, []
 
-    image_files_found = any(f.lower().endswith(tuple(f".{ext}" for ext in ALLOWED_IMAGE_TYPES)) for r, _, files in os.walk(target_dir) for f in files)
-    if not image_files_found:
-        st.error("❌ No valid image files were found after processing uploads.")
-        return False
-    return True
-
-# --- Helper function for resizing with padding ---
-def resize_with_padding(img, target_width, target_height, bg_color=(255, 255, 255)):
-    original_ratio = img.width / img.height
-    target_ratio = target_width / target_height
-    if original_ratio > target_ratio:
-        new_width = target_width
-        new_height = int(new_width / original_ratio)
-    else:
-        new_height = target_height
-        new_width = int(new_height * original_ratio)
-    
-    try: from PIL.Image import Resampling; resized_img = img.resize((new_width, new_height), Resampling.LANCZOS)
-    except ImportError: resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+    file_hashes = [hashlib.sha256(uploaded_file.getvalue()).hexdigest() for uploaded_file in uploaded_files]
+    input_hash = hashlib.sha256("".join(f.name + h for f, h in zip(uploaded_files, file_hashes)).encode()).hexdigest()
+    target_dir = os.path.join(products_root, input_hash[:16])
 
-    new_img = Image.new("RGBA", (target_width, target_height), bg_color + (255,))
-    paste_x = (target_width - new_width) // 2
-    paste_y = (target_height - new_height) // 2
-    new_img.paste(resized_img, (paste_x, paste_y), resized_img if resized_img.mode == 'RGBA' else None)
-    return new_img
+    if os.path.isdir(target_dir):
+        touch_paths(target_dir)
+    else:
+        # Extract into a staging folder and rename it into place, so an interrupted run never
+        # leaves a half-filled folder that a later rerun would take as complete.
+        staging_dir = tempfile.mkdtemp(prefix=STAGING_DIR_PREFIX, dir=products_root)
+        with st.spinner("Preparing uploaded images..."):
+            seen_hashes = set()
+            for uploaded_file, file_hash in zip(uploaded_files, file_hashes):
+                # The same bytes uploaded twice (e.g. the same ZIP dropped again) are only extracted once.
+                if file_hash in seen_hashes: continue
+                seen_hashes.add(file_hash)
+                try:
+                    is_zip = False
+                    if uploaded_file.type in KNOWN_ZIP_MIMES or (uploaded_file.name and uploaded_file.name.lower().endswith(".zip")):
+                        is_zip = True
+                    
+                    if is_zip:
+                        # UploadedFile is already an in-memory, seekable buffer; read it in place.
+                        uploaded_file.seek(0)
+                        with zipfile.ZipFile(uploaded_file, "r") as zip_ref:
+                            for info in zip_ref.infolist():
+                                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS) and not info.filename.startswith(MACOSX_DIR):
+                                    zip_ref.extract(info, staging_dir)
+                    else:
+                        file_ext = os.path.splitext(uploaded_file.name)[1].lower().lstrip('.')
+                        if (uploaded_file.type and uploaded_file.type.split('/')[-1] in ALLOWED_IMAGE_TYPES) or (file_ext in ALLOWED_IMAGE_TYPES):
+                            with open(os.path.join(staging_dir, uploaded_file.name), "wb") as f:
+                                f.write(uploaded_file.getvalue())
+                        else:
+                            st.warning(f"⚠️ Skipping unsupported file type: `{uploaded_file.name}`")
+                except Exception as e:
+                    st.error(f"❌ Error processing `{uploaded_file.name}`: {e}")
+        # Another session may have finished extracting the same uploads in the meantime.
+        try: os.rename(staging_dir, target_dir)
+        except OSError: shutil.rmtree(staging_dir, ignore_errors=True)
+        remove_old_entries(products_root, PRODUCT_DIRS_KEPT)
+
+    image_files = list(iter_images(target_dir))
+    if not image_files:
+        st.error("❌ No valid image files were found after processing uploads.")
+    return target_dir, image_files
 
 # --- Main App Logic ---
 if not check_password():
@@ -105,7 +197,7 @@ if not check_password():
 st.set_page_config(layout="wide")
 st.title("🖼️ JhumJhum's Brand Watermark App")
 
-for folder in [PRODUCTS_DIR, OUTPUT_DIR]:
+for folder in [PRODUCTS_DIR, LOGOS_DIR]:
     os.makedirs(folder, exist_ok=True)
 
 col1, col2 = st.columns(2)
@@ -119,10 +211,11 @@ if not logo_file or not uploaded_files:
     st.stop()
 
 try:
-    # --- THE DEFINITIVE FIX ---
-    # Open the uploaded file and convert to RGBA. This handles all formats gracefully.
-    # All strict checks have been removed.
-    original_logo = Image.open(BytesIO(logo_file.getvalue())).convert("RGBA")
+    # Fail fast on a logo that does not decode, once, before anything is submitted; the workers
+    # decode it to RGBA from the stored copy, which handles every format Pillow can open.
+    logo_bytes = logo_file.getvalue()
+    check_logo(logo_bytes)
+    logo_path = store_logo(logo_bytes, LOGOS_DIR)
 
     # --- Configuration ---
     st.sidebar.header("⚙️ Customization")
@@ -133,6 +226,11 @@ try:
     }
     selected_dimensions_names = st.sidebar.multiselect("Select output sizes", options=list(DIMENSIONS.keys()), default=["Original Size", "Instagram Post (1:1)"])
     resize_bg_color = ImageColor.getrgb(st.sidebar.color_picker("Background color for padding", "#FFFFFF"))
+    output_format = st.sidebar.selectbox("Output format", [AUTO_FORMAT] + list(OUTPUT_FORMATS.keys()), index=1, help="JPEG and WebP encode much faster and smaller than PNG; JPEG drops transparency. Auto writes JPEG for JPEG products and PNG for the rest.")
+    png_compress_level = PNG_COMPRESS_LEVEL
+    if output_format in ("PNG", AUTO_FORMAT):
+        png_compress_level = st.sidebar.slider("PNG compression level", 0, 9, PNG_COMPRESS_LEVEL, 1, help="Higher levels give slightly smaller files but encode much slower.")
+    compress_zip = st.sidebar.checkbox("Compress ZIP download", False, help="Images are already compressed, so this saves little space for extra time.")
 
     st.sidebar.subheader("💧 Watermark & Logo")
     logo_scale = st.sidebar.slider("Logo Size", 0.05, 0.5, DEFAULT_LOGO_SCALE, 0.01)
@@ -145,124 +243,122 @@ try:
     horizontal_spacing = st.sidebar.slider("Text Spacing", 10, 200, 50, 10)
     padding = st.sidebar.slider("Edge Padding", 5, 100, DEFAULT_PADDING, 5)
 
-    try: font = ImageFont.truetype(FONT_FILENAME, font_size)
-    except IOError:
-        st.sidebar.warning(f"Font '{FONT_FILENAME}' not found. Using default."); font = ImageFont.load_default()
-
-    if not prepare_input_images(uploaded_files, PRODUCTS_DIR):
-        st.stop()
+    if load_font(FONT_FILENAME, font_size) is None:
+        st.sidebar.warning(f"Font '{FONT_FILENAME}' not found. Using default.")
 
-    files_to_process = [os.path.join(r, f) for r, _, fs in os.walk(PRODUCTS_DIR) for f in fs if not f.startswith('.') and f.lower().endswith(tuple(f".{ext}" for ext in ALLOWED_IMAGE_TYPES))]
+    products_dir, files_to_process = prepare_input_images(uploaded_files, PRODUCTS_DIR)
     if not files_to_process:
-        st.warning("⚠️ No valid image files found after filtering."); st.stop()
+        st.stop()
 
     st.write(f"Found {len(files_to_process)} source images to process.")
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    processed_images_map = {}
+    processed_images_map, previews_map = {}, {}
     processed_count, error_count = 0, 0
     text_color = ImageColor.getrgb(watermark_color_hex) + (int(255 * opacity),)
 
-    if os.path.exists(OUTPUT_DIR): shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
-
-    for i, product_path in enumerate(files_to_process):
-        base_fname = os.path.basename(product_path)
-        status_text.text(f"Processing: {base_fname} ({i + 1}/{len(files_to_process)})")
-        processed_images_map[base_fname] = []
-        
+    config = {
+        "logo_scale": logo_scale, "add_logo_backdrop": add_logo_backdrop, "brand_name": brand_name,
+        "font_filename": FONT_FILENAME, "font_size": font_size, "text_color": text_color,
+        "position": position, "horizontal_spacing": horizontal_spacing, "padding": padding,
+        "dimensions": [(name, DIMENSIONS.get(name)) for name in selected_dimensions_names],
+        "resize_bg_color": resize_bg_color, "output_format": output_format,
+        "png_compress_level": png_compress_level, "products_dir": products_dir,
+    }
+    # Reruns that change nothing the workers see (a download click, the ZIP checkbox) reuse the
+    # last error-free batch instead of processing every image again. The logo path and the
+    # config's uploads folder are both named after the content's hash, so a key can only match
+    # this session's own uploads. Keeping the batch's encoded outputs and previews in
+    # session_state for the rest of the session is deliberate: it trades memory for not
+    # re-encoding the whole batch on every download click.
+    run_key = (logo_path, repr(config))
+    last_run = st.session_state.get("last_run")
+    if last_run and last_run[0] == run_key:
+        processed_images_map, previews_map, processed_count = last_run[1], last_run[2], last_run[3]
+        progress_bar.progress(1.0)
+    else:
+        # Keyed on the path inside the upload: a ZIP can hold red/front.jpg and blue/front.jpg.
+        for product_path in files_to_process:
+            processed_images_map[os.path.relpath(product_path, products_dir)] = []
+
+        # Largest images first so no worker is left finishing one big file at the end.
+        submit_order = sorted(files_to_process, key=pixel_count, reverse=True)
+        executor = get_executor()
+        touch_paths(products_dir, logo_path)
+        futures = {executor.submit(process_one, p, config, logo_path): os.path.relpath(p, products_dir) for p in submit_order}
+        # Every progress update is a message to the browser; large batches refresh about 100 times.
+        progress_every = max(1, len(files_to_process) // 100)
         try:
-            product_img = Image.open(product_path).convert("RGBA")
-            watermark_layer = Image.new("RGBA", product_img.size, (0, 0, 0, 0))
-            draw = ImageDraw.Draw(watermark_layer)
-
-            logo = original_logo.copy()
-            target_w = max(1, int(product_img.width * logo_scale))
-            target_h = max(1, int(target_w * (logo.height / logo.width)))
-            logo_resized = logo.resize((target_w, target_h), Image.LANCZOS)
-            x_logo, y_logo = product_img.width - target_w - padding, product_img.height - target_h - padding
-            if add_logo_backdrop:
-                backdrop = Image.new("RGBA", logo_resized.size, DEFAULT_BACKDROP_COLOR)
-                watermark_layer.paste(backdrop, (x_logo + DEFAULT_BACKDROP_OFFSET[0], y_logo + DEFAULT_BACKDROP_OFFSET[1]), backdrop)
-            watermark_layer.paste(logo_resized, (x_logo, y_logo), logo_resized)
-
-            if brand_name.strip():
-                bbox = draw.textbbox((0, 0), brand_name.strip(), font=font, anchor="lt")
-                w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
-                if w > 0:
-                    y_text = {"Top": padding, "Middle": (product_img.height - h) // 2}.get(position, product_img.height - h - padding)
-                    for x in range(-w, product_img.width + w, w + horizontal_spacing):
-                        draw.text((x, y_text), brand_name.strip(), font=font, fill=text_color, anchor="lt")
-            
-            final_image = Image.alpha_composite(product_img, watermark_layer)
-            out_fname_base = os.path.splitext(base_fname)[0]
-
-            for dim_name in selected_dimensions_names:
-                target_dims = DIMENSIONS.get(dim_name)
-                output_sub_dir = os.path.dirname(os.path.join(OUTPUT_DIR, os.path.relpath(product_path, PRODUCTS_DIR)))
-                os.makedirs(output_sub_dir, exist_ok=True)
-                
-                if target_dims:
-                    resized_img = resize_with_padding(final_image, target_dims[0], target_dims[1], resize_bg_color)
-                    out_fname = f"{out_fname_base}_branded_{target_dims[0]}x{target_dims[1]}.png"
-                    out_path = os.path.join(output_sub_dir, out_fname)
-                    resized_img.save(out_path, "PNG")
-                else:
-                    out_fname = f"{out_fname_base}_branded_original.png"
-                    out_path = os.path.join(output_sub_dir, out_fname)
-                    final_image.save(out_path, "PNG")
-                
-                processed_images_map[base_fname].append({"path": out_path, "dim_name": dim_name})
-            
-            processed_count += 1
-        except Exception as e:
-            st.error(f"❌ Failed to process `{base_fname}`: {e}"); error_count += 1
-        
-        progress_bar.progress((i + 1) / len(files_to_process))
+            for i, future in enumerate(as_completed(futures)):
+                rel_path = futures[future]
+                try:
+                    _, versions, previews_map[rel_path] = future.result()
+                    processed_images_map[rel_path].extend(versions)
+                    processed_count += 1
+                except BrokenProcessPool as e:
+                    get_executor.clear()
+                    st.error(f"❌ Failed to process `{rel_path}`: {e}"); error_count += 1
+                except Exception as e:
+                    st.error(f"❌ Failed to process `{rel_path}`: {e}"); error_count += 1
+
+                if (i + 1) % progress_every == 0 or i + 1 == len(files_to_process):
+                    status_text.text(f"Processed: {rel_path} ({i + 1}/{len(files_to_process)})")
+                    progress_bar.progress((i + 1) / len(files_to_process))
+                    touch_paths(products_dir, logo_path)
+        finally:
+            # A widget change interrupts this run; don't leave its queued images on the shared pool.
+            for future in futures: future.cancel()
+        if not error_count: st.session_state["last_run"] = (run_key, processed_images_map, previews_map, processed_count)
 
     status_text.text(f"Processing complete. {processed_count} images processed, {error_count} errors.")
-    all_processed_paths = [v['path'] for versions in processed_images_map.values() for v in versions]
+    all_processed = [v for versions in processed_images_map.values() for v in versions]
 
-    if not all_processed_paths:
+    if not all_processed:
         st.error("🚫 No images were processed successfully."); st.stop()
 
     st.subheader("🖼️ Preview (First 5 Results)")
-    cols = st.columns(min(len(all_processed_paths), 5))
-    for idx, path in enumerate(all_processed_paths[:len(cols)]):
-        with cols[idx]: st.image(path, caption=os.path.basename(path), use_container_width=True)
+    # One preview per product, so a run with several sizes still shows five different products.
+    previews = [(rel_path, preview) for rel_path, preview in previews_map.items() if preview]
+    cols = st.columns(min(len(previews), 5))
+    for idx, (rel_path, preview) in enumerate(previews[:len(cols)]):
+        with cols[idx]: st.image(preview, caption=rel_path, use_container_width=True)
 
     st.subheader("⬇️ Individual Downloads")
-    for base_fname, versions in processed_images_map.items():
+    for rel_path, versions in processed_images_map.items():
         if not versions: continue
-        with st.expander(f"Downloads for: {base_fname}"):
+        with st.expander(f"Downloads for: {rel_path}"):
             col1, col2 = st.columns([1, 2])
             with col1:
-                st.image(versions[0]['path'], use_container_width=True)
+                st.image(previews_map[rel_path], use_container_width=True)
             with col2:
                 for version in versions:
-                    with open(version['path'], "rb") as f:
-                        st.download_button(
-                            label=f"Download '{version['dim_name']}'",
-                            data=f.read(),
-                            file_name=os.path.basename(version['path']),
-                            mime="image/png",
-                            key=f"dl_{base_fname}_{version['dim_name']}"
-                        )
+                    st.download_button(
+                        label=f"Download '{version['dim_name']}'",
+                        data=version['bytes'],
+                        file_name=os.path.basename(version['arcname']),
+                        mime=version['mime'],
+                        key=f"dl_{rel_path}_{version['dim_name']}"
+                    )
 
     st.subheader("📦 Download All as ZIP")
     with st.spinner("Zipping processed images..."):
+        # Built in memory on purpose, not in a spooled or on-disk file: every entry's bytes already
+        # live in memory (last_run keeps the batch), and download_button reads any file it is given
+        # back into bytes for Streamlit's in-memory media store, so disk would not lower the peak.
         zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in all_processed_paths:
-                zipf.write(file_path, arcname=os.path.relpath(file_path, OUTPUT_DIR))
-        zip_buffer.seek(0)
+        # PNG, JPEG and WebP are already compressed; storing them skips a near-useless zlib pass.
+        if compress_zip: zip_args = {"compression": zipfile.ZIP_DEFLATED, "compresslevel": 1}
+        else: zip_args = {"compression": zipfile.ZIP_STORED}
+        with zipfile.ZipFile(zip_buffer, "w", **zip_args) as zipf:
+            for version in all_processed:
+                zipf.writestr(version['arcname'], version['bytes'])
     
     st.download_button(
-        label=f"📦 Download All ({len(all_processed_paths)}) Branded Images",
-        data=zip_buffer, file_name="branded_images.zip", mime="application/zip"
+        label=f"📦 Download All ({len(all_processed)}) Branded Images",
+        data=zip_buffer.getvalue(), file_name="branded_images.zip", mime="application/zip"
     )
 
 except Exception as e:
     st.error("An unexpected error occurred in the main workflow:")
-    st.error(traceback.format_exc())
+    st.exception(e)
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# Per-image branding pipeline. Kept free of Streamlit calls so it can run inside
+# ProcessPoolExecutor workers; the app only submits jobs and renders the results.
+import os
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from io import BytesIO
+from collections import OrderedDict
+try: from numba import njit
+except ImportError: njit = None
+try: import pyvips
+except (ImportError, OSError): pyvips = None
+try: from PIL.Image import Resampling; LANCZOS = Resampling.LANCZOS
+except ImportError: LANCZOS = Image.LANCZOS
+
+# --- Constants ---
+DEFAULT_BACKDROP_COLOR = (255, 255, 255, 180)
+DEFAULT_BACKDROP_OFFSET = (2, 2)
+PNG_COMPRESS_LEVEL = 1
+JPEG_QUALITY = 92
+OUTPUT_FORMATS = {
+    "PNG": {"ext": "png", "mime": "image/png", "save": {"compress_level": PNG_COMPRESS_LEVEL, "optimize": False}, "vips_save": {"compression": PNG_COMPRESS_LEVEL}},
+    "JPEG": {"ext": "jpg", "mime": "image/jpeg", "save": {"quality": JPEG_QUALITY, "optimize": True}, "vips_save": {"Q": JPEG_QUALITY, "optimize_coding": True}},
+    "WEBP": {"ext": "webp", "mime": "image/webp", "save": {"quality": JPEG_QUALITY, "method": 4}, "vips_save": {"Q": JPEG_QUALITY}},
+}
+# "Auto" keeps JPEG products as JPEG and writes everything else as PNG.
+AUTO_FORMAT = "Auto"
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+PRODUCT_CACHE_BYTES = 64 * 1024 * 1024
+TEXT_STRIP_CACHE_SIZE = 16
+LOGO_STAMP_CACHE_SIZE = 32
+LOGO_REDUCING_GAP = 3.0
+PREVIEW_SIZE = 512
+
+# --- Per-worker caches (filled lazily in each process) ---
+_logo_cache = {}
+_logo_stamp_cache = {}
+_font_cache = {}
+_text_strip_cache = {}
+_measure_draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+_product_cache = OrderedDict()
+
+# What pasting DEFAULT_BACKDROP_COLOR through its own alpha leaves on a transparent pixel; the
+# backdrop is a solid rectangle of this value, so it is filled rather than blended.
+_backdrop_px = Image.new("RGBA", (1, 1), DEFAULT_BACKDROP_COLOR)
+_backdrop_probe = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
+_backdrop_probe.paste(_backdrop_px, (0, 0), _backdrop_px)
+_backdrop_fill = _backdrop_probe.getpixel((0, 0))
+
+# Decoded products are kept per worker in an LRU keyed on the file's identity and the draft
+# size, so a rerun that only changes watermark settings skips the decode. The pool is shared by
+# every session and never shuts down, so each worker holds at most PRODUCT_CACHE_BYTES of pixels
+# (cpu_count times that overall) and products larger than that are never kept.
+def load_product(product_path, draft_size):
+    stat = os.stat(product_path)
+    key = (product_path, stat.st_mtime_ns, stat.st_size, draft_size)
+    if key in _product_cache:
+        _product_cache.move_to_end(key)
+        return _product_cache[key]
+
+    # When every output is a fixed size, let libjpeg decode large JPEGs at 1/2, 1/4 or 1/8
+    # scale (still at least twice the largest target).
+    source_img = Image.open(product_path)
+    full_width = source_img.width
+    if draft_size and source_img.format == "JPEG":
+        source_img.draft("RGB", draft_size)
+    # Opaque products stay 3-channel; the blend kernel only reads their RGB planes.
+    product_opaque = not has_alpha(source_img)
+    if product_opaque: product_img = source_img if source_img.mode == "RGB" else source_img.convert("RGB")
+    else: product_img = source_img if source_img.mode == "RGBA" else source_img.convert("RGBA")
+    product_img.load()
+    if product_img is not source_img: source_img.close()
+    entry = (product_img, full_width, product_opaque)
+
+    if image_bytes(product_img) <= PRODUCT_CACHE_BYTES:
+        _product_cache[key] = entry
+        while sum(image_bytes(cached[0]) for cached in _product_cache.values()) > PRODUCT_CACHE_BYTES:
+            _product_cache.popitem(last=False)[1][0].close()
+    return entry
+
+def image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+# The app writes each logo once to a file named after its hash, so jobs carry only the path
+# and every worker reads and decodes a given logo a single time.
+def get_logo(logo_path):
+    if logo_path not in _logo_cache:
+        _logo_cache.clear(); _logo_stamp_cache.clear()
+        with Image.open(logo_path) as logo: _logo_cache[logo_path] = logo.convert("RGBA")
+    return _logo_cache[logo_path]
+
+def get_font(font_filename, font_size):
+    key = (font_filename, font_size)
+    if key not in _font_cache:
+        try: _font_cache[key] = ImageFont.truetype(font_filename, font_size)
+        except IOError: _font_cache[key] = ImageFont.load_default()
+    return _font_cache[key]
+
+# Catalog batches share a handful of widths, so each (width, height) is resized once. The
+# stamp is the resized logo with its backdrop already painted underneath (offset by
+# DEFAULT_BACKDROP_OFFSET), exactly as the two pastes would leave an empty layer, so the
+# box layer takes it with a single unmasked paste. Large logos shrunk to a few percent are
+# box-reduced by an integer factor first (reducing_gap), leaving LANCZOS a short final step.
+def get_logo_stamp(original_logo, target_w, target_h, add_backdrop):
+    key = (target_w, target_h, add_backdrop)
+    if key not in _logo_stamp_cache:
+        if len(_logo_stamp_cache) >= LOGO_STAMP_CACHE_SIZE: _logo_stamp_cache.clear()
+        logo_resized = original_logo.resize((target_w, target_h), LANCZOS, reducing_gap=LOGO_REDUCING_GAP)
+        if add_backdrop:
+            ox, oy = DEFAULT_BACKDROP_OFFSET
+            stamp = Image.new("RGBA", (target_w + ox, target_h + oy), (0, 0, 0, 0))
+            stamp.paste(_backdrop_fill, (ox, oy, ox + target_w, oy + target_h))
+            stamp.paste(logo_resized, (0, 0), logo_resized)
+        else:
+            stamp = Image.new("RGBA", logo_resized.size, (0, 0, 0, 0))
+            stamp.paste(logo_resized, (0, 0), logo_resized)
+        _logo_stamp_cache[key] = stamp
+    return _logo_stamp_cache[key]
+
+# The tiled text row only depends on the text, font, spacing and image width, so it is
+# measured once and stamped with the fill colour per image through an "L" coverage mask.
+# The text itself is rasterized a single time into a tile cropped to its ink box (so tiles
+# never overlap); the row is that tile plus its spacing gap repeated with np.tile, then
+# shifted so the first copy starts at x = -w like the original draw loop.
+# Returns (strip, top, text_height), or None when the text has no width. The pool outlives
+# reruns, so the cache is dropped once it holds TEXT_STRIP_CACHE_SIZE strips.
+def get_text_strip(text, font, spacing, width):
+    key = (text, font, spacing, width)
+    if key not in _text_strip_cache:
+        if len(_text_strip_cache) >= TEXT_STRIP_CACHE_SIZE: _text_strip_cache.clear()
+        bbox = _measure_draw.textbbox((0, 0), text, font=font, anchor="lt")
+        w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        if w <= 0:
+            _text_strip_cache[key] = None
+            return None
+        top = min(0, bbox[1])
+        tile = Image.new("L", (w, bbox[3] - top), 0)
+        ImageDraw.Draw(tile).text((-bbox[0], -top), text, font=font, fill=255, anchor="lt")
+        step, x0 = w + spacing, bbox[0] - w
+        pattern = np.zeros((tile.height, step), np.uint8)
+        pattern[:, :w] = np.asarray(tile)
+        row = np.tile(pattern, (1, (width - x0) // step + 1))
+        strip_arr = np.zeros((tile.height, width), np.uint8)
+        if x0 >= 0: strip_arr[:, x0:] = row[:, :max(0, width - x0)]
+        else: strip_arr[:] = row[:, -x0:width - x0]
+        _text_strip_cache[key] = (Image.fromarray(strip_arr, "L"), top, h)
+    return _text_strip_cache[key]
+
+# When numba is installed the same blend runs as a compiled per-pixel loop that skips the
+# fully transparent pixels (most of the layer). It stays single-threaded on purpose: the
+# process pool already puts one image on every core.
+if njit:
+    @njit(cache=True)
+    def _blend_over_kernel(prod, wm, out):
+        for y in range(out.shape[0]):
+            for x in range(out.shape[1]):
+                a = int(wm[y, x, 3])
+                for c in range(3):
+                    if a == 0: out[y, x, c] = prod[y, x, c]
+                    else:
+                        t = int(wm[y, x, c]) * a + int(prod[y, x, c]) * (255 - a) + 128
+                        out[y, x, c] = (t + (t >> 8)) >> 8
+
+# Integer "over" blend for an opaque product: out = (wm * a + prod * (255 - a)) / 255,
+# rounded with the (t + (t >> 8)) >> 8 trick so the whole pass stays in uint16. The result is
+# RGB: an opaque product stays opaque, so it never carries an alpha channel.
+def blend_over_opaque(product_img, watermark_layer):
+    if njit:
+        out = np.empty((product_img.height, product_img.width, 3), np.uint8)
+        _blend_over_kernel(np.asarray(product_img), np.asarray(watermark_layer), out)
+        return Image.fromarray(out, "RGB")
+    prod = np.asarray(product_img)[..., :3].astype(np.uint16)
+    wm = np.asarray(watermark_layer).astype(np.uint16)
+    a = wm[..., 3:4]
+    t = wm[..., :3] * a + prod * (255 - a) + 128
+    return Image.fromarray(((t + (t >> 8)) >> 8).astype(np.uint8), "RGB")
+
+# Clamp (x0, y0, x1, y1) boxes to the image and merge those whose rows overlap or touch into
+# their bounding box.
+def merge_boxes(boxes, width, height):
+    merged = []
+    clamped = [(max(0, x0), max(0, y0), min(width, x1), min(height, y1)) for x0, y0, x1, y1 in boxes]
+    for x0, y0, x1, y1 in sorted(clamped, key=lambda box: box[1]):
+        if x0 >= x1 or y0 >= y1: continue
+        if merged and y0 <= merged[-1][3]:
+            mx0, my0, mx1, my1 = merged[-1]
+            merged[-1] = (min(mx0, x0), my0, max(mx1, x1), max(my1, y1))
+        else: merged.append((x0, y0, x1, y1))
+    return merged
+
+def has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+# new_from_memory tags the buffer "multiband", which libvips treats as having no alpha band;
+# retagged as sRGB, a fourth band is alpha and libvips premultiplies it around a resize.
+def to_vips(img):
+    vimg = pyvips.Image.new_from_memory(img.tobytes(), img.width, img.height, len(img.mode), "uchar")
+    return vimg.copy(interpretation="srgb")
+
+# libvips resamples with lanczos3 over tiles; it is used for the output-size resizes when
+# pyvips (and the libvips shared library) is installed.
+def resize_with_vips(img, new_width, new_height):
+    vimg = to_vips(img).thumbnail_image(new_width, height=new_height, size="force")
+    return Image.frombuffer(img.mode, (vimg.width, vimg.height), vimg.write_to_memory(), "raw", img.mode, 0, 1)
+
+# An opaque white half on a transparent black canvas must keep white edges through libvips, as
+# it does through Pillow; if it picks up grey fringes instead, RGBA resizes stay on Pillow.
+def vips_resize_matches_pillow():
+    probe = Image.new("RGBA", (9, 9), (0, 0, 0, 0))
+    probe.paste((255, 255, 255, 255), (0, 0, 4, 9))
+    try: vips_img = resize_with_vips(probe, 4, 4)
+    except pyvips.Error: return False
+    vips_px = np.asarray(vips_img, dtype=np.int16)
+    pil_px = np.asarray(probe.resize((4, 4), LANCZOS), dtype=np.int16)
+    alpha_ok = np.abs(vips_px[..., 3] - pil_px[..., 3]) <= 16
+    colour_ok = np.abs(vips_px[..., :3] - pil_px[..., :3]).max(axis=-1) <= 16
+    # Colour is meaningless where a pixel is (nearly) transparent, so only the visible ones count.
+    visible = np.minimum(vips_px[..., 3], pil_px[..., 3]) >= 64
+    return bool(np.all(alpha_ok & (colour_ok | ~visible)))
+
+_vips_rgba_resize = pyvips is not None and vips_resize_matches_pillow()
+
+# --- Helper function for resizing with padding ---
+# `source` may be a smaller resize of `img` (same aspect ratio) to resample from instead of
+# the full-resolution image, as long as it is still at least as large as the result.
+def resize_with_padding(img, target_width, target_height, bg_color=(255, 255, 255), source=None):
+    original_ratio = img.width / img.height
+    target_ratio = target_width / target_height
+    if original_ratio > target_ratio:
+        new_width = target_width
+        new_height = int(new_width / original_ratio)
+    else:
+        new_height = target_height
+        new_width = int(new_height * original_ratio)
+
+    if source is not None and new_width <= source.width < img.width and source.height >= new_height:
+        img = source
+    if pyvips and (img.mode == "RGB" or (img.mode == "RGBA" and _vips_rgba_resize)):
+        resized_img = resize_with_vips(img, new_width, new_height)
+    else:
+        resized_img = img.resize((new_width, new_height), LANCZOS)
+
+    new_img = Image.new(img.mode, (target_width, target_height), bg_color + (255,) if img.mode == "RGBA" else bg_color)
+    paste_x = (target_width - new_width) // 2
+    paste_y = (target_height - new_height) // 2
+    new_img.paste(resized_img, (paste_x, paste_y), resized_img if resized_img.mode == 'RGBA' else None)
+    return new_img, resized_img
+
+# JPEG has no alpha channel, so transparent areas are flattened onto the padding colour.
+# With pyvips available the encode runs in libvips (libspng / libjpeg-turbo / libwebp).
+def encode_image(img, output_format, bg_color, png_compress_level=PNG_COMPRESS_LEVEL):
+    if output_format == "JPEG" and img.mode != "RGB":
+        flat = Image.new("RGB", img.size, bg_color)
+        flat.paste(img, (0, 0), img if img.mode == "RGBA" else None)
+        img = flat
+    fmt = OUTPUT_FORMATS[output_format]
+    if pyvips and img.mode in ("RGB", "RGBA"):
+        vips_save = dict(fmt["vips_save"], compression=png_compress_level) if output_format == "PNG" else fmt["vips_save"]
+        return to_vips(img).write_to_buffer(f".{fmt['ext']}", **vips_save)
+    save = dict(fmt["save"], compress_level=png_compress_level) if output_format == "PNG" else fmt["save"]
+    buf = BytesIO()
+    img.save(buf, output_format, **save)
+    return buf.getvalue()
+
+# The page shows small JPEG previews so reruns don't send every full-size output to the browser.
+def encode_preview(img, bg_color):
+    scale = PREVIEW_SIZE / max(img.size)
+    if scale < 1:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), LANCZOS, reducing_gap=LOGO_REDUCING_GAP)
+    return encode_image(img, "JPEG", bg_color)
+
+# --- Watermark a single product image and write every requested size ---
+# `config` is a plain dict so it pickles cleanly across the process pool. Returns the file name,
+# the encoded versions and one preview of the first version for the page.
+def process_one(product_path, config, logo_path):
+    base_fname = os.path.basename(product_path)
+    original_logo = get_logo(logo_path)
+    text = config["brand_name"].strip()
+    versions, preview = [], None
+
+    targets = [d for _, d in config["dimensions"]]
+    draft_size = (2 * max(w for w, _ in targets), 2 * max(h for _, h in targets)) if targets and all(targets) else None
+    product_img, full_width, product_opaque = load_product(product_path, draft_size)
+    width, height = product_img.size
+
+    # Pixel-sized settings follow any draft downscale so the watermark keeps its proportions.
+    scale = width / full_width
+    font = get_font(config["font_filename"], max(1, round(config["font_size"] * scale)))
+    padding = round(config["padding"] * scale)
+    spacing = round(config["horizontal_spacing"] * scale)
+
+    target_w = max(1, int(width * config["logo_scale"]))
+    target_h = max(1, int(target_w * (original_logo.height / original_logo.width)))
+    logo_stamp = get_logo_stamp(original_logo, target_w, target_h, config["add_logo_backdrop"])
+    x_logo, y_logo = width - target_w - padding, height - target_h - padding
+    boxes = [(x_logo, y_logo, x_logo + logo_stamp.width, y_logo + logo_stamp.height)]
+
+    text_strip = get_text_strip(text, font, spacing, width) if text else None
+    if text_strip:
+        strip, top, h = text_strip
+        y_text = {"Top": padding, "Middle": (height - h) // 2}.get(config["position"], height - h - padding)
+        y_strip = y_text + top
+        boxes.append((0, y_strip, width, y_strip + strip.height))
+
+    # Only the pixels under the logo stamp and the text strip are blended, each box through its
+    # own box-sized watermark layer; everything else is copied from the product unchanged.
+    # Opaque products are painted and encoded as RGB, without a constant alpha channel.
+    final_image = product_img.copy()
+    for x0, y0, x1, y1 in merge_boxes(boxes, width, height):
+        layer = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+        layer.paste(logo_stamp, (x_logo - x0, y_logo - y0))
+        if text_strip:
+            layer.paste(config["text_color"], (-x0, y_strip - y0), strip)
+        region = product_img.crop((x0, y0, x1, y1))
+        if product_opaque: final_image.paste(blend_over_opaque(region, layer), (x0, y0))
+        else: final_image.paste(Image.alpha_composite(region, layer), (x0, y0))
+    out_fname_base = os.path.splitext(base_fname)[0]
+
+    # Build the sized outputs largest first so each smaller one is resampled from the previous
+    # (unpadded) resize rather than from the full-resolution composite.
+    sized_outputs, pyramid_source = {}, None
+    for target_dims in sorted({d for _, d in config["dimensions"] if d}, key=lambda d: d[0] * d[1], reverse=True):
+        sized_outputs[target_dims], pyramid_source = resize_with_padding(final_image, target_dims[0], target_dims[1], config["resize_bg_color"], pyramid_source)
+
+    output_format = config["output_format"]
+    if output_format == AUTO_FORMAT:
+        output_format = "JPEG" if base_fname.lower().endswith(JPEG_EXTENSIONS) else "PNG"
+    out_ext = OUTPUT_FORMATS[output_format]["ext"]
+    output_sub_dir = os.path.dirname(os.path.relpath(product_path, config["products_dir"]))
+    for dim_name, target_dims in config["dimensions"]:
+        if target_dims:
+            out_img = sized_outputs[target_dims]
+            out_fname = f"{out_fname_base}_branded_{target_dims[0]}x{target_dims[1]}.{out_ext}"
+        else:
+            out_img = final_image
+            out_fname = f"{out_fname_base}_branded_original.{out_ext}"
+
+        # Outputs never touch the disk: the encoded bytes go back to the app, which serves the
+        # downloads and writes them into the ZIP under `arcname` (the input's folder layout).
+        out_bytes = encode_image(out_img, output_format, config["resize_bg_color"], config["png_compress_level"])
+        versions.append({"arcname": os.path.join(output_sub_dir, out_fname), "dim_name": dim_name, "bytes": out_bytes, "mime": OUTPUT_FORMATS[output_format]["mime"]})
+        if len(versions) == 1: preview = encode_preview(out_img, config["resize_bg_color"])
+
+    # Hand the full-size pixel buffers back to the allocator now rather than whenever GC runs,
+    # so a long batch holds about one image's worth of buffers per worker.
+    for img in (final_image, *sized_outputs.values()):
+        img.close()
+    if not any(entry[0] is product_img for entry in _product_cache.values()): product_img.close()
+    return base_fname, versions, preview